@@ -4,8 +4,10 @@
 # Written by Kevin Ivarsen
 # Copyright 2014-2021 PlaneWave Instruments
 
+import concurrent.futures
 import socket
-import struct
+import threading
+import time
 import serial
 
 
@@ -27,17 +29,15 @@ class Enum:
     """
 
     def __init__(self, **kwargs):
-        self._namesToValues = kwargs
+        # Store the names as real attributes so lookups don't go through __getattr__
+        self.__dict__.update(kwargs)
         self._valuesToNames = dict()
-        for k, v in list(self._namesToValues.items()):
+        for k, v in list(kwargs.items()):
             self._valuesToNames[v] = k
 
     def getName(self, value):
         return self._valuesToNames.get(value, "UNKNOWN(%r)" % value)
 
-    def __getattr__(self, name):
-        return self._namesToValues[name]
-
 
 class SerialCommSession:
     BAUD_RATE = 19200  # Default baud rate for EFA Kit. For devices with built-in USB ports, this does not matter.
@@ -46,6 +46,13 @@ class SerialCommSession:
         self.port = serial.Serial(comPort, self.BAUD_RATE)
         self.useRtsCts = useRtsCts
 
+        if hasattr(self.port, "setTimeout"):
+            # Earlier versions of pyserial used setTimeout()
+            self._setPortTimeout = self.port.setTimeout
+        else:
+            # More recent versions use "timeout" property
+            self._setPortTimeout = self._setTimeoutProperty
+
         if self.useRtsCts:
             # Lower the RTS line
             # Otherwise we monopoloze the serial network and handcontroller
@@ -53,21 +60,27 @@ class SerialCommSession:
             self.port.setRTS(False)
 
     def setTimeout(self, timeout_sec):
-        if "setTimeout" in dir(self.port):
-            # Earlier versions of pyserial used setTimeout()
-            self.port.setTimeout(timeout_sec)
-        else:
-            # More recent versions use "timeout" property
-            self.port.timeout = timeout_sec
+        self._setPortTimeout(timeout_sec)
+
+    def _setTimeoutProperty(self, timeout_sec):
+        self.port.timeout = timeout_sec
 
     def close(self):
+        if hasattr(self.port, "cancel_read"):
+            # Wake up any thread that is blocked in read (pyserial 3.1 and newer)
+            self.port.cancel_read()
         self.port.close()
 
     def takeBus(self):
         if self.useRtsCts:
+            # Give up after the read timeout rather than waiting forever on a stuck CTS line
+            timeout = self.port.timeout
+            start = time.monotonic()
             while self.port.getCTS() == True:
                 # print "Waiting for CTS..."
-                pass
+                if timeout is not None and time.monotonic() - start > timeout:
+                    raise Exception("Timed out waiting for CTS")
+                time.sleep(0.0005)
 
             self.port.setRTS(True)
 
@@ -75,8 +88,19 @@ class SerialCommSession:
         if self.useRtsCts:
             self.port.setRTS(False)
 
-    def readByte(self):
-        return self.port.read(1)
+    def readExact(self, numBytes):
+        """
+        Read numBytes bytes in a single call.
+        May return fewer bytes if the read times out.
+        """
+        return self.port.read(numBytes)
+
+    def readAvailable(self):
+        """
+        Read everything that is currently buffered by the serial driver,
+        blocking for at least one byte (or the timeout) if nothing is waiting.
+        """
+        return self.port.read(max(1, self.port.in_waiting))
 
     def write(self, bytes):
         self.port.write(bytes)
@@ -85,12 +109,21 @@ class SerialCommSession:
 class TcpCommSession:
     def __init__(self, host, tcpPort):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # Packets are only a few bytes long, so send them immediately instead of waiting for Nagle's algorithm
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
         self.socket.connect((host, tcpPort))
 
     def setTimeout(self, timeout_sec):
-        self.socket.settimeout(1)
+        self.socket.settimeout(timeout_sec)
 
     def close(self):
+        try:
+            # Wake up any thread that is blocked in recv
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Already disconnected
         self.socket.close()
 
     def takeBus(self):
@@ -99,8 +132,38 @@ class TcpCommSession:
     def releaseBus(self):
         pass  # This concept doesn't apply to TCP connections
 
-    def readByte(self):
-        return self.socket.recv(1)
+    def readExact(self, numBytes):
+        """
+        Read numBytes bytes, looping over recv_into until they have all arrived.
+        May return fewer bytes if the read times out.
+        """
+        buffer = bytearray(numBytes)
+        view = memoryview(buffer)
+        received = 0
+        while received < numBytes:
+            try:
+                count = self.socket.recv_into(view[received:])
+            except socket.timeout:
+                break
+
+            if count == 0:
+                raise ConnectionError("Connection closed by remote host")
+            received += count
+
+        return bytes(buffer[:received])
+
+    def readAvailable(self):
+        """
+        Read whatever data has arrived, blocking for at least one byte (or the timeout).
+        """
+        try:
+            data = self.socket.recv(4096)
+        except socket.timeout:
+            return b""
+
+        if not data:
+            raise ConnectionError("Connection closed by remote host")
+        return data
 
     def write(self, bytes):
         self.socket.sendall(bytes)
@@ -111,8 +174,13 @@ class AuxSession:
         self.myAddress = myAddress  # Default address of the PC
         self.debug = False  # If true, print some extra logging messages
         self.abortOnTimeout = True
+        self._rxbuf = bytearray()  # Bytes read from the comm session that have not yet been parsed
+        self._reader = None  # Background thread that reads from the comm session
+        self._readerStop = None  # Event used to tell _reader to exit
 
     def openSerial(self, comPort, useRtsCts=False):
+        self._stopReader()
+        self._rxbuf = bytearray()
         self.comm = SerialCommSession(comPort, useRtsCts)
 
         # The EFA kit allows multiple devices to communicate simultaneously
@@ -123,95 +191,266 @@ class AuxSession:
         self.useRtsCts = useRtsCts
 
         # Set the receive timeout to 1 second.
-        self.comm.setTimeout(1)
+        self.timeout = 1
+        self.comm.setTimeout(self.timeout)
+        self._startReader()
 
     def openTcp(self, host, tcpPort):
+        self._stopReader()
+        self._rxbuf = bytearray()
         self.comm = TcpCommSession(host, tcpPort)
-        self.comm.setTimeout(5)
+        self.timeout = 5
+        self.comm.setTimeout(self.timeout)
         self.useRtsCts = False
+        self._startReader()
 
     def close(self):
+        if self._readerStop is not None:
+            self._readerStop.set()
+
+        # Closing the port wakes the reader if it is blocked in a read
         self.comm.close()
+        self._stopReader()
 
-    def send(self, receiverAddress, command, *data):
-        packet = AuxPacket(self.myAddress, receiverAddress, command, *data)
+    def _stopReader(self):
+        """
+        Tell the reader thread to exit, and wait for it to finish
+        """
+
+        if self._reader is None:
+            return
+
+        self._readerStop.set()
+        self._reader.join()
+        self._reader = None
+
+    def _startReader(self):
+        """
+        Start the background thread that owns all reads from self.comm
+        and hands response packets to the callers waiting on them
+        """
+
+        self._writeLock = threading.Lock()  # Held for a full send/receive round trip
+        self._pendingLock = threading.Lock()  # Protects _pending and _numAcks
+        self._pending = []  # (receiverAddress, command, Future) for each request awaiting a response, in send order
+        self._numAcks = 0  # Number of sent packets that the EFA kit has not yet echoed back
+        self._readerError = None
+
+        # Each reader has its own stop event and comm session, so that a reader
+        # that is still shutting down can never touch a newly opened port
+        self._readerStop = threading.Event()
+        self._reader = threading.Thread(target=self._readerThread, args=(self.comm, self._readerStop), daemon=True)
+        self._reader.start()
+
+    def _readerThread(self, comm, stop):
+        while not stop.is_set():
+            try:
+                packet = self.readNextPacket(comm)
+                if packet is not None:
+                    self._dispatch(packet, comm)
+            except Exception as exception:
+                # The port has been closed or has failed, or packet handling hit a bug.
+                # Either way nothing more can be read, so pass the error on to anyone waiting
+                with self._pendingLock:
+                    if not stop.is_set():
+                        print("(reader stopped: %r)" % exception)
+                        self._readerError = exception
+                    for _, _, future in self._pending:
+                        future.set_exception(exception)
+                    self._pending = []
+                return
+
+    def _dispatch(self, packet, comm):
+        with self._pendingLock:
+            # An EFA kit echoes everything back, so expect to
+            # read the packets that we just sent.
+            # USB-based devices (Delta-T, mirror cover controller)
+            # will simply send back the response straight away
+            if self._numAcks > 0 and packet.sourceAddress == self.myAddress:
+                self._numAcks -= 1
+                if self._numAcks == 0:
+                    comm.releaseBus()
+                return
+
+            if self.debug:
+                print("Response: " + packet.description())
+
+            if packet.receiverAddress != self.myAddress:
+                if self.debug:
+                    print("  (Ignored by PC)")
+                return
+
+            # Match on the command as well as the device so that a late reply
+            # can never be handed to a different request to the same device
+            for i, (address, command, future) in enumerate(self._pending):
+                if address == packet.sourceAddress and command == packet.command:
+                    del self._pending[i]
+                    future.set_result(packet)
+                    return
+
+            if self.debug:
+                print("  (Unexpected response)")
+
+    def _write(self, packetBytes, numPackets, requests=()):
+        """
+        Claim the bus and write packetBytes (containing numPackets packets)
+        after registering the requests that are waiting for a response
+        """
+
+        if self._readerError is not None:
+            raise self._readerError
 
         if self.debug:
-            print("Send: %r" % packet.toHexString())
+            print("Send: %r" % " ".join(["%02X" % x for x in packetBytes]))
+
+        with self._pendingLock:
+            self._pending.extend(requests)
+            if self.useRtsCts:
+                self._numAcks += numPackets
+
+        try:
+            self.comm.takeBus()
+
+            # Always hand the whole buffer to a single write so that USB serial
+            # adapters can send it in one transfer instead of fragmenting it
+            self.comm.write(packetBytes)
+        except Exception:
+            with self._pendingLock:
+                for request in requests:
+                    self._pending.remove(request)
+                if self.useRtsCts:
+                    self._numAcks -= numPackets
+            raise
+
+    def send(self, receiverAddress, command, *data):
+        packet = AuxPacket(self.myAddress, receiverAddress, command, *data)
+        self.sendRaw(packet.toBytes())
 
-        self.comm.takeBus()
+    def sendRaw(self, packetBytes):
+        """
+        Send a packet that has already been encoded by AuxPacket.toBytes()
+        """
 
-        self.comm.write(packet.toBytes())
+        # Nobody waits for a response here, so with RTS/CTS the bus is
+        # released by the reader thread once the EFA kit echoes the packet back
+        with self._writeLock:
+            self._write(packetBytes, 1)
 
     def sendReceive(self, receiverAddress, command, *data):
         """
         Send a packet, and return the response packet
         """
 
-        self.send(receiverAddress, command, *data)
+        packet = AuxPacket(self.myAddress, receiverAddress, command, *data)
+        return self.sendReceiveRaw(packet.toBytes())
 
-        if self.useRtsCts:
-            # An EFA kit echoes everything back, so expect to
-            # read the packet that we just sent.
-            # USB-based devices (Delta-T, mirror cover controller)
-            # will simply send back the response straight away
-            ackPacket = self.readNextPacket()
-            if ackPacket is None:
-                print("(timeout on ack)")
-                return None  # Timeout
+    def sendReceiveRaw(self, packetBytes):
+        """
+        Send a packet that has already been encoded by AuxPacket.toBytes(),
+        and return the response packet
+        """
 
-            self.comm.releaseBus()
+        return self.sendReceiveMany((packetBytes,))[0]
 
-        while True:
-            response = self.readNextPacket()
-            if response is None:
-                print("(timeout on response packet)")
-                return None  # Timeout
+    def sendReceiveMany(self, packets):
+        """
+        Send several packets that have already been encoded by AuxPacket.toBytes()
+        back-to-back using a single write, and return a list of the response packets.
+        Responses that time out are returned as None
+        """
 
-            if self.debug:
-                print("Response: " + response.description())
+        # The receiver address and command are the 4th and 5th bytes of each packet
+        requests = [(packet[3], packet[4], concurrent.futures.Future()) for packet in packets]
+
+        # Only one round trip may be in progress at a time so that the bus is
+        # released as soon as our packets have been echoed back
+        with self._writeLock:
+            self._write(b"".join(packets), len(packets), requests)
+
+            responses = []
+            for _, _, future in requests:
+                try:
+                    responses.append(future.result(timeout=self.timeout))
+                except concurrent.futures.TimeoutError:
+                    responses.append(None)
+
+            with self._pendingLock:
+                if self._numAcks > 0:
+                    print("(timeout on ack)")
+                    self._numAcks = 0
+                    self.comm.releaseBus()
+                elif None in responses:
+                    print("(timeout on response packet)")
 
-            if response.receiverAddress == self.myAddress:
-                return response
-            elif self.debug:
-                print("  (Ignored by PC)")
+                for request in requests:
+                    if request in self._pending:
+                        self._pending.remove(request)
 
-    def readNextByte(self):
-        c = self.comm.readByte()
-        if len(c) == 0:
-            return None
-        return ord(c)
+        return responses
+
+    def readExact(self, numBytes, comm=None):
+        """
+        Read numBytes bytes, consuming any data left over from the SOM scan first.
+        May return fewer bytes if the read times out.
+        """
+        if comm is None:
+            comm = self.comm
+
+        data = bytes(self._rxbuf[:numBytes])
+        del self._rxbuf[:numBytes]
+        if len(data) < numBytes:
+            data += comm.readExact(numBytes - len(data))
+        return data
+
+    def readNextPacket(self, comm=None):
+        if comm is None:
+            comm = self.comm
 
-    def readNextPacket(self):
-        # scan for SOM
         while True:
-            c = self.readNextByte()
-            if c == None:
-                if self.abortOnTimeout:
-                    return None  # No packet on timeout
-                else:
-                    print("...")
-                    continue
-
-            if c == AuxPacket.SOM:
+            # scan for SOM
+            while True:
+                if not self._rxbuf:
+                    self._rxbuf += comm.readAvailable()
+                    if not self._rxbuf:
+                        if self.abortOnTimeout:
+                            return None  # No packet on timeout
+                        else:
+                            print("...")
+                            continue
+
+                index = self._rxbuf.find(AuxPacket.SOM)
+                if self.debug and index != 0:
+                    skipped = self._rxbuf[:index] if index >= 0 else self._rxbuf
+                    print("Ignore: %s" % " ".join(["%02X" % c for c in skipped]))
+
+                if index >= 0:
+                    del self._rxbuf[:index + 1]
+                    break
+
+                self._rxbuf.clear()
+
+            # LEN, SRC, RCV, CMD
+            header = self.readExact(4, comm)
+            if len(header) < 4:
+                return None  # Timeout
+            numBytes, sourceAddress, receiverAddress, command = header
+
+            if numBytes >= 3:
                 break
 
+            # LEN must at least cover SrcAdr, DstAdr, and Cmd, so this SOM was noise.
+            # Put the header back and resume scanning in case a real packet starts inside it
             if self.debug:
-                print("Ignore: %02X (%s)" % (c, chr(c)))
-
-        numBytes = self.readNextByte()
-        sourceAddress = self.readNextByte()
-        receiverAddress = self.readNextByte()
-        command = self.readNextByte()
-
-        data = []
-        for i in range(numBytes - 3):  # After SrcAdr, DstAdr, and Cmd, the rest of the numbered bytes are data
-            data.append(self.readNextByte())
+                print("Ignore: %02X (invalid length %d)" % (AuxPacket.SOM, numBytes))
+            self._rxbuf[0:0] = header
 
-        checksum = self.readNextByte()
+        # After SrcAdr, DstAdr, and Cmd, the rest of the numbered bytes are data, followed by the checksum
+        body = self.readExact(numBytes - 3 + 1, comm)
+        if len(body) < numBytes - 3 + 1:
+            return None  # Timeout
 
-        packet = AuxPacket(sourceAddress, receiverAddress, command, *data)
-        packet.receivedChecksumByte = checksum
+        packet = AuxPacket(sourceAddress, receiverAddress, command, body[:-1])
+        packet.receivedChecksumByte = body[-1]
 
         return packet
 
@@ -237,43 +476,59 @@ class AuxPacket:
     SOM = 0x3B  # Start of Message byte
 
     def __init__(self, sourceAddress, receiverAddress, command, *dataBytes):
+        """
+        dataBytes may be given either as individual byte values,
+        or as a single bytes/bytearray object holding the whole payload
+        """
+
         self.sourceAddress = sourceAddress
         self.receiverAddress = receiverAddress
         self.command = command
-        self.data = dataBytes
+
+        if len(dataBytes) == 1 and isinstance(dataBytes[0], (bytes, bytearray)):
+            dataBytes = dataBytes[0]
+
+        # bytes() checks that everything is in range, and doesn't copy if we already have bytes
+        try:
+            self.data = bytes(dataBytes)
+        except ValueError:
+            raise Exception("EfaPacket data byte out of range: cmd=%02X, data=%r" % (self.command, dataBytes))
 
         self.receivedChecksumByte = None  # Caller can set this when a received packet includes a checksum
+        self._bytes = None  # Cached result of toBytes()
 
-        # Make sure things are in range
-        for byte in self.data:
-            if byte < 0 or byte > 255:
-                raise Exception("EfaPacket data byte out of range: cmd=%02X, data=%r" % (self.command, self.data))
+    def _checksum(self):
+        # Sum of fields, excluding SOM and CHK; the checksum is the LSB of its two's complement
+        numBytes = 3 + len(self.data)
+        return -(numBytes + self.sourceAddress + self.receiverAddress + self.command + sum(self.data)) & 0xFF
 
     def calculatedChecksum(self):
-        return self.toBytes()[-1]
+        return self._checksum()
 
     def isChecksumOk(self):
         """
         Depends on caller first setting receivedChecksumByte
         """
 
-        print("CHK Calculated: %02X  Received: %02X" % (self.calculatedChecksum(), self.receivedChecksumByte))
         return self.receivedChecksumByte == self.calculatedChecksum()
 
     def toBytes(self):
-        numBytes = 3 + len(self.data)
-
-        packetFormat = "BBBBB" + ("B" * len(self.data)) + "B"
-
-        packetFields = [AuxPacket.SOM, numBytes, self.sourceAddress, self.receiverAddress, self.command]
-        packetFields.extend(self.data)
-
-        checksum = sum(
-            packetFields[1:])  # Sum of fields, excluding SOM (and CHK, which we haven't included yet of course)
-        checksum = -checksum & 0xFF  # LSB of the two's complement
-        packetFields += [checksum]
-
-        return struct.pack(packetFormat, *packetFields)
+        if self._bytes is not None:
+            return self._bytes
+
+        dataLength = len(self.data)
+        packet = bytearray(5 + dataLength + 1)
+        packet[0] = AuxPacket.SOM
+        packet[1] = 3 + dataLength
+        packet[2] = self.sourceAddress
+        packet[3] = self.receiverAddress
+        packet[4] = self.command
+        packet[5:5 + dataLength] = self.data
+        packet[-1] = self._checksum()
+
+        # Packets are not modified after construction, so the encoded form can be reused
+        self._bytes = bytes(packet)
+        return self._bytes
 
     def toHexString(self):
         bytes = self.toBytes()
@@ -285,7 +540,7 @@ class AuxPacket:
         Return the data array as a string of bytes
         """
 
-        return bytes(self.data)
+        return self.data
 
     def parseData(self):
         """
@@ -293,12 +548,7 @@ class AuxPacket:
         as one or more MSB-first bytes, return the value
         """
 
-        value = 0
-
-        for byte in self.data:
-            value = value << 8 | byte
-
-        return value
+        return int.from_bytes(self.data, 'big')
 
     def description(self):
         if self.receivedChecksumByte is None:
@@ -306,7 +556,8 @@ class AuxPacket:
         elif self.isChecksumOk():
             checksumOk = "OK"
         else:
-            checksumOk = "FAILED"
+            checksumOk = "FAILED (calculated %02X, received %02X)" % (self.calculatedChecksum(),
+                                                                   self.receivedChecksumByte)
 
         if len(self.data) <= 3:
             parsedValue = self.parseData()
@@ -317,7 +568,7 @@ class AuxPacket:
             self.sourceAddress,
             self.receiverAddress,
             self.command,
-            self.data,
+            tuple(self.data),
             parsedValue,
             checksumOk,
             self.toHexString())
@@ -333,12 +584,7 @@ class AuxPacket:
         """
         Values sent to the EFA are commonly encoded as 3 bytes
         packed MSB first. Given an integer value, return a
-        tuple of 3 bytes that encode that value
+        bytes object of length 3 that encodes that value
         """
 
-        lsb = value & 0xFF
-        value >>= 8
-        middle = value & 0xFF
-        value >>= 8
-        msb = value & 0xFF
-        return (msb, middle, lsb)
+        return (value & 0xFFFFFF).to_bytes(3, 'big')
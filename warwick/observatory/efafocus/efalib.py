@@ -51,42 +51,62 @@ Command = Enum(
 )
 
 class EfaSession:
+    # Motor address, indexed by useRotator
+    _ADDR = (Address.FOC_TEMP, Address.ROT_FAN)
+
     def __init__(self, comPort):
         self.aux = AuxSession()
         self.aux.openSerial(comPort, useRtsCts=True)
 
+        # Pre-encode the packets for commands without a payload, which are sent repeatedly when polling
+        def encode(address, command):
+            return AuxPacket(self.aux.myAddress, address, command).toBytes()
+
+        self._getPosPackets = tuple(encode(address, Command.MTR_GET_POS) for address in self._ADDR)
+        self._gotoOverPackets = tuple(encode(address, Command.MTR_GOTO_OVER) for address in self._ADDR)
+        self._getFansPacket = encode(Address.ROT_FAN, Command.FANS_GET)
+        self._getVersionPacket = encode(Address.FOC_TEMP, Command.GET_VERSION)
+
+        # Target of the last gotoPos2 for each motor, indexed by useRotator
+        self._gotoTargets = [None, None]
+
     def getVersion(self):
-        response = self.aux.sendReceive(Address.FOC_TEMP,
-                                    Command.GET_VERSION)
+        response = self.aux.sendReceiveRaw(self._getVersionPacket)
         version = "%d.%d" % (response.data[0], response.data[1])
         return version
 
     def gotoPos2(self, target, useRotator=False):
-        if useRotator:
-            address = Address.ROT_FAN
-        else:
-            address = Address.FOC_TEMP
+        address = self._ADDR[bool(useRotator)]
+        self._gotoTargets[bool(useRotator)] = target
 
         response = self.aux.sendReceive(address,
                                     Command.MTR_GOTO_POS2,
-                                    *AuxPacket.intTo3Bytes(target))
+                                    AuxPacket.intTo3Bytes(target))
 
         return response
 
     def monitorGotoPos2(self, useRotator=False, printPosStatus=True, tickConversion=0):
         """
         Monitor movement status of an axis until a gotoPos2 command is complete
+
+        The polling interval is shortened as the motor approaches the target of the last gotoPos2
         """
 
+        target = self._gotoTargets[bool(useRotator)]
+        getPosPacket = self._getPosPackets[bool(useRotator)]
+        gotoOverPacket = self._gotoOverPackets[bool(useRotator)]
+        lastPosTicks = None
+        lastPosTime = None
+
         numErrors = 0 # Count the number of consecutive communication errors
         while True:
             # NOTE: near the end of a gotoPos2, it is possible for the EFA
             # to stop responding to commands for about 100 milliseconds.
             # We should be willing to retry these commands
 
-            posRaw = self.getMotorPosition(useRotator)
-            isGotoOverRaw = self.isGotoOver(useRotator)
+            posRaw, isGotoOverRaw = self.aux.sendReceiveMany((getPosPacket, gotoOverPacket))
 
+            delay = 0.5
             if posRaw is None or isGotoOverRaw is None:
                 numErrors += 1
                 print("Warning - no response during goto (maybe normal) - attempt %d of 3" % numErrors)
@@ -114,16 +134,21 @@ class EfaSession:
                 elif isGotoOver == 0xFE:
                     print("Goto2 ABORTED")
                     return
-            time.sleep(0.5)
 
-    def isGotoOver(self, useRotator=False):
-        if useRotator:
-            address = Address.ROT_FAN
-        else:
-            address = Address.FOC_TEMP
+                # Poll again around when we expect to arrive, based on the speed since the last poll
+                now = time.monotonic()
+                if target is not None and lastPosTicks is not None:
+                    ticksPerSec = abs(currentPosTicks - lastPosTicks) / (now - lastPosTime)
+                    if ticksPerSec > 0:
+                        delay = min(0.5, max(0.05, abs(target - currentPosTicks) / ticksPerSec))
 
-        response = self.aux.sendReceive(address,
-                                    Command.MTR_GOTO_OVER)
+                lastPosTicks = currentPosTicks
+                lastPosTime = now
+
+            time.sleep(delay)
+
+    def isGotoOver(self, useRotator=False):
+        response = self.aux.sendReceiveRaw(self._gotoOverPackets[bool(useRotator)])
 
         return response
 
@@ -145,10 +170,7 @@ class EfaSession:
             0	0
         """
 
-        if useRotator:
-            address = Address.ROT_FAN
-        else:
-            address = Address.FOC_TEMP
+        address = self._ADDR[bool(useRotator)]
 
         response = self.aux.sendReceive(address,
                                     Command.MTR_PMSLEW_RATE,
@@ -162,10 +184,7 @@ class EfaSession:
         useRotator: if true, move Rotator motor; else move Focus motor
         """
 
-        if useRotator:
-            address = Address.ROT_FAN
-        else:
-            address = Address.FOC_TEMP
+        address = self._ADDR[bool(useRotator)]
 
         response = self.aux.sendReceive(address,
                                     Command.MTR_NMSLEW_RATE,
@@ -174,28 +193,20 @@ class EfaSession:
         return response
 
     def trackPositive(self, rate, useRotator=False):
-        if useRotator:
-            address = Address.ROT_FAN
-        else:
-            address = Address.FOC_TEMP
+        address = self._ADDR[bool(useRotator)]
 
-        byte1, byte2, byte3 = AuxPacket.intTo3Bytes(rate)
         response = self.aux.sendReceive(address,
                                     Command.MTR_PTRACK,
-                                    byte1, byte2, byte3)
+                                    AuxPacket.intTo3Bytes(rate))
 
         return response
 
     def trackNegative(self, rate, useRotator=False):
-        if useRotator:
-            address = Address.ROT_FAN
-        else:
-            address = Address.FOC_TEMP
+        address = self._ADDR[bool(useRotator)]
 
-        byte1, byte2, byte3 = AuxPacket.intTo3Bytes(rate)
         response = self.aux.sendReceive(address,
                                     Command.MTR_NTRACK,
-                                    byte1, byte2, byte3)
+                                    AuxPacket.intTo3Bytes(rate))
 
         return response
 
@@ -229,31 +240,20 @@ class EfaSession:
 
 
     def getMotorPosition(self, useRotator=False):
-        if useRotator:
-            address = Address.ROT_FAN
-        else:
-            address = Address.FOC_TEMP
-
-        response = self.aux.sendReceive(address,
-                                    Command.MTR_GET_POS)
+        response = self.aux.sendReceiveRaw(self._getPosPackets[bool(useRotator)])
         return response
 
     def setEncoder(self, newEncoderValueTicks, useRotator=False):
-        if useRotator:
-            address = Address.ROT_FAN
-        else:
-            address = Address.FOC_TEMP
-
-        byte1, byte2, byte3 = AuxPacket.intTo3Bytes(newEncoderValueTicks)
+        address = self._ADDR[bool(useRotator)]
 
         response = self.aux.sendReceive(address,
-                                    Command.MTR_OFFSET_CNT, byte1, byte2, byte3)
+                                    Command.MTR_OFFSET_CNT,
+                                    AuxPacket.intTo3Bytes(newEncoderValueTicks))
 
         return response
 
     def getFanState(self):
-        response = self.aux.sendReceive(Address.ROT_FAN,
-                                    Command.FANS_GET)
+        response = self.aux.sendReceiveRaw(self._getFansPacket)
 
         return response
 
@@ -290,6 +290,10 @@ class EfaSession:
             return (256*response.data[1] + response.data[0]) / 16.0
 
 
+# Raw temperature is a signed 16 bit value expressed in 16ths of a degree C
+# There are only 65536 possible values, so convert them all up front
+_RAW_TO_CELSIUS = tuple((i - 0x10000 if i & 0x8000 else i) / 16.0 for i in range(0x10000))
+
 def rawTemperatureToCelsius(rawTemp, byte2=None):
     """
     Accepts as arguments either (MSB, LSB) or a single raw temperature value
@@ -299,18 +303,11 @@ def rawTemperatureToCelsius(rawTemp, byte2=None):
     if byte2 is not None:
         rawTemp = rawTemp + byte2*256
 
-    if rawTemp & 0x8000: # Is high bit set? If so, value is negative
-        rawTemp = rawTemp - 0x10000
-
-    # Raw temperature is expressed in 16ths of a degree C
-    # A simple division gives us C
-    return rawTemp / 16.0
+    return _RAW_TO_CELSIUS[rawTemp & 0xFFFF]
 
 def celsiusToRawTemperature(celsius):
-    rawTemp = int(celsius*16)
-    if rawTemp < 0:
-        rawTemp += 65536
-    return rawTemp
+    # Masking gives the two's complement representation of negative values
+    return int(celsius*16) & 0xFFFF
 
 def celsiusToRawTemperatureBytes(celsius):
     rawTemp = celsiusToRawTemperature(celsius)